@@ -1,14 +1,1089 @@
 #!/usr/bin/python
 
 import argparse
-import re, os, sys, shutil, urllib, subprocess, glob
+import re, os, sys, shutil, urllib, subprocess, glob, struct
+import json, fcntl, errno, stat, time, atexit, tarfile, threading, signal
+# Imported here, not lazily by os.wait4(), which fails if another thread
+# holds the import lock
+import resource
+import urllib2, urlparse, httplib, Queue, copy, functools, fnmatch
 import osc.conf, osc.core, yaml, md5, pycurl
 from StringIO import StringIO
 from debian.changelog import Changelog, Version
+from debian.debian_support import version_compare
 import deb822
 from pprint import pprint
 
 
+########################################################################
+# External process runner
+########################################################################
+class ProcessRunner(object):
+    # Start and reap external tools, enforcing timeouts and accounting
+    # for wall time, CPU time and max RSS per tool (from wait4() rusage)
+    poll_interval_max = 0.1
+    log_tail_lines = 20
+
+    def __init__(self):
+        self.timeout = None   # Default timeout in seconds; None = no limit
+        self.timeouts = {}    # Per-tool timeouts, keyed on basename(argv[0])
+        self.log_dir = None   # If set, command output is logged here
+        self.totals = {}
+        self.runs = []
+        self.log_seq = 0
+        self.lock = threading.Lock()
+
+    def tool_name(self, cmd):
+        return os.path.basename(cmd[0])
+
+    def start(self, cmd, **kwargs):
+        # Like subprocess.Popen(); reap the result with wait().  Each tool
+        # runs in its own process group, so that kill() also reaches its
+        # children, e.g. make and gencontrol under `debian/rules`
+        log_path = None
+        if self.log_dir is not None and 'stderr' not in kwargs:
+            if not os.path.exists(self.log_dir):
+                os.makedirs(self.log_dir)
+            with self.lock:
+                self.log_seq += 1
+                log_path = os.path.join(self.log_dir, '%03d-%s.log' % (
+                        self.log_seq, self.tool_name(cmd)))
+            log_f = open(log_path, 'w')
+            if 'stdout' not in kwargs:
+                kwargs['stdout'] = log_f
+            kwargs['stderr'] = log_f
+        p = subprocess.Popen(cmd, preexec_fn=os.setpgrp, **kwargs)
+        p.runner_cmd = cmd
+        p.runner_log_path = log_path
+        p.runner_start_time = time.time()
+        if log_path is not None:
+            log_f.close()
+        return p
+
+    def kill(self, p):
+        # Kill the process's whole process group
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def wait(self, p):
+        # Reap the process with wait4(), killing it if it runs past its
+        # timeout; return the exit status as Popen.wait() would
+        tool = self.tool_name(p.runner_cmd)
+        timeout = self.timeouts.get(tool, self.timeout)
+        timed_out = False
+        interval = 0.001
+        try:
+            while True:
+                try:
+                    if timeout is None or timed_out:
+                        pid, status, rusage = os.wait4(p.pid, 0)
+                    else:
+                        pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid != 0:
+                    break
+                if time.time() - p.runner_start_time > timeout:
+                    print "    Killing `%s` after %gs timeout" % \
+                        (' '.join(p.runner_cmd), timeout)
+                    self.kill(p)
+                    timed_out = True
+                    continue
+                time.sleep(interval)
+                interval = min(interval * 2, self.poll_interval_max)
+        except BaseException:
+            # E.g. KeyboardInterrupt, which the tool's own process group
+            # doesn't get from the terminal; don't leave it running
+            exc_info = sys.exc_info()
+            self.kill(p)
+            try:
+                os.waitpid(p.pid, 0)
+            except OSError:
+                pass  # Already reaped
+            p.returncode = -signal.SIGKILL
+            # A bare `raise` would re-raise the OSError above
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        self.account(p, rusage, timed_out)
+
+        if p.returncode and p.runner_log_path is not None:
+            print "    `%s` exited %d; last output from '%s':" % \
+                (' '.join(p.runner_cmd), p.returncode, p.runner_log_path)
+            with open(p.runner_log_path, 'r') as f:
+                for line in f.readlines()[-self.log_tail_lines:]:
+                    print "        %s" % line.rstrip()
+        if timed_out:
+            raise OBSBuildRuntimeError("`%s` timed out after %gs" %
+                                       (' '.join(p.runner_cmd), timeout))
+        return p.returncode
+
+    def run(self, cmd, **kwargs):
+        return self.wait(self.start(cmd, **kwargs))
+
+    def check_output(self, cmd, **kwargs):
+        # Run a command and return its stdout; raise on non-zero exit
+        p = self.start(cmd, stdout=subprocess.PIPE, **kwargs)
+        # Read from a thread so wait() enforces the timeout meanwhile
+        chunks = []
+        reader = threading.Thread(target=lambda: chunks.append(p.stdout.read()))
+        reader.daemon = True
+        reader.start()
+        try:
+            returncode = self.wait(p)
+        finally:
+            reader.join()
+            p.stdout.close()
+        output = ''.join(chunks)
+        if returncode:
+            raise OBSBuildRuntimeError("`%s` returned %d" %
+                                       (' '.join(cmd), p.returncode))
+        return output
+
+    def account(self, p, rusage, timed_out):
+        tool = self.tool_name(p.runner_cmd)
+        run = dict(
+            cmd = list(p.runner_cmd),
+            returncode = p.returncode,
+            timed_out = timed_out,
+            wall_seconds = time.time() - p.runner_start_time,
+            user_seconds = rusage.ru_utime,
+            system_seconds = rusage.ru_stime,
+            max_rss_bytes = rusage.ru_maxrss * 1024,  # Linux reports KiB
+            log = p.runner_log_path,
+            )
+        with self.lock:
+            self.runs.append(run)
+            t = self.totals.setdefault(tool, dict(
+                    runs = 0, failures = 0, timeouts = 0,
+                    wall_seconds = 0.0, user_seconds = 0.0,
+                    system_seconds = 0.0, max_rss_bytes = 0))
+            t['runs'] += 1
+            t['failures'] += int(p.returncode != 0)
+            t['timeouts'] += int(timed_out)
+            for k in ('wall_seconds', 'user_seconds', 'system_seconds'):
+                t[k] += run[k]
+            t['max_rss_bytes'] = max(t['max_rss_bytes'], run['max_rss_bytes'])
+
+    prometheus_metrics = (
+        # (metric suffix, totals key, type, help)
+        ('runs_total', 'runs', 'counter', 'External tool runs'),
+        ('failures_total', 'failures', 'counter',
+         'External tool runs exiting non-zero'),
+        ('timeouts_total', 'timeouts', 'counter',
+         'External tool runs killed on timeout'),
+        ('wall_seconds_total', 'wall_seconds', 'counter',
+         'External tool wall clock time'),
+        ('user_seconds_total', 'user_seconds', 'counter',
+         'External tool user CPU time'),
+        ('system_seconds_total', 'system_seconds', 'counter',
+         'External tool system CPU time'),
+        ('max_rss_bytes', 'max_rss_bytes', 'gauge',
+         'External tool peak resident set size'),
+        )
+
+    def write_metrics(self, metrics_dir, package):
+        # Write totals as a Prometheus textfile-collector file plus a
+        # JSON summary with per-command detail
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        with self.lock:
+            totals = dict((k, dict(v)) for k, v in self.totals.items())
+            runs = list(self.runs)
+        lines = []
+        for suffix, key, mtype, help_text in self.prometheus_metrics:
+            name = 'obsprep_process_%s' % suffix
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, mtype))
+            for tool in sorted(totals):
+                lines.append('%s{package="%s",tool="%s"} %s' %
+                             (name, package, tool, totals[tool][key]))
+        prom_path = os.path.join(metrics_dir, 'obsprep_%s.prom' % package)
+        tmp_path = '%s.%d.tmp' % (prom_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, prom_path)
+
+        json_path = os.path.join(metrics_dir, 'obsprep_%s.json' % package)
+        write_json(json_path, dict(
+                package = package,
+                time = time.time(),
+                totals = totals,
+                runs = runs,
+                ))
+        print "Wrote process metrics to '%s' and '%s'" % (prom_path, json_path)
+
+
+########################################################################
+# Shared caches
+########################################################################
+class LockedFile(object):
+    # Exclusive flock() on a lock file; used as a context manager to
+    # serialize access to caches shared between concurrent builds
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            # Truncated by a killed process; start over
+            return default
+
+
+def write_json(path, data):
+    # Write to a temp file and rename, so readers never see a partial file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def set_tree_writable(path, writable):
+    # Add or remove write permission bits throughout a tree
+    for dirpath, dirnames, filenames in os.walk(path):
+        for p in [dirpath] + [os.path.join(dirpath, f) for f in filenames]:
+            if os.path.islink(p):
+                continue
+            mode = os.stat(p).st_mode
+            if writable:
+                os.chmod(p, mode | stat.S_IWUSR)
+            else:
+                os.chmod(p, mode & ~(stat.S_IWUSR|stat.S_IWGRP|stat.S_IWOTH))
+
+
+def remove_tree(path):
+    # shutil.rmtree() fails on read-only directories
+    if not os.path.exists(path):
+        return
+    set_tree_writable(path, True)
+    shutil.rmtree(path)
+
+
+def discard_tree(path):
+    # Rename a cache entry aside before removing it, so a kill midway
+    # never leaves a partial entry under its real name
+    if not os.path.exists(path):
+        return
+    del_path = '%s.%d.del' % (path, os.getpid())
+    remove_tree(del_path)
+    os.rename(path, del_path)
+    remove_tree(del_path)
+
+
+def sweep_stale(cache_dir):
+    # Remove *.<pid>.tmp and *.<pid>.del leftovers of dead processes;
+    # call with the cache lock held
+    for name in os.listdir(cache_dir):
+        parts = name.rsplit('.', 2)
+        if len(parts) != 3 or parts[2] not in ('tmp', 'del') or \
+                not parts[1].isdigit() or pid_is_alive(int(parts[1])):
+            continue
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            remove_tree(path)
+        else:
+            os.remove(path)
+
+
+class DigestMemo(object):
+    # md5sums of large files, memoized on (size, mtime) so unchanged
+    # tarballs aren't re-read on every run
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.memo_path = os.path.join(cache_dir, 'digests.json')
+        self.lock_path = os.path.join(cache_dir, 'digests.lock')
+
+    def md5sum(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime]
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with LockedFile(self.lock_path):
+            memo = read_json(self.memo_path, {})
+            entry = memo.get(path)
+            if entry is not None and entry['stamp'] == stamp:
+                return entry['md5sum']
+        m = md5.new()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1024*1024)
+                if len(chunk) == 0: break
+                m.update(chunk)
+        with LockedFile(self.lock_path):
+            memo = read_json(self.memo_path, {})
+            memo[path] = dict(stamp = stamp, md5sum = m.hexdigest())
+            write_json(self.memo_path, memo)
+        return m.hexdigest()
+
+
+class ExtractedTreeCache(object):
+    # Read-only extracted trees of auxiliary tarballs (e.g. Xenomai and
+    # RTAI sources), keyed on tarball content and shared between runs
+    # and packages.
+    #
+    # Each entry records the pids of builds referencing it; entries
+    # with no live referrers are evicted least-recently-used first once
+    # there are more than `max_entries`.
+    max_entries = 6
+
+    def __init__(self, cache_dir, runner):
+        self.cache_dir = cache_dir
+        self.runner = runner
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, 'lock')
+        self.digests = DigestMemo(os.path.dirname(cache_dir))
+        self.held = set()
+
+    def tree_key(self, tarball_path, strip_components):
+        return "%s-%d" % (self.digests.md5sum(tarball_path), strip_components)
+
+    def live_refs(self, entry):
+        return [pid for pid in entry.get('refs', []) if pid_is_alive(pid)]
+
+    def extract(self, tarball_path, strip_components, tree_dir):
+        # Extract into a temp dir and rename, so a killed extraction never
+        # leaves a partial tree behind
+        tmp_dir = '%s.%d.tmp' % (tree_dir, os.getpid())
+        remove_tree(tmp_dir)
+        os.makedirs(tmp_dir)
+        tar_cmd = ('tar', 'xCf', tmp_dir, tarball_path,
+                   '--strip-components=%d' % strip_components)
+        print "        Running command:  %s" % ' '.join(tar_cmd)
+        if self.runner.run(tar_cmd) != 0:
+            remove_tree(tmp_dir)
+            raise OBSBuildRuntimeError("Extract tarball '%s' into '%s' failed" %
+                                       (tarball_path, tmp_dir))
+        set_tree_writable(tmp_dir, False)
+        os.rename(tmp_dir, tree_dir)
+
+    def evict(self, index):
+        trees = index['trees']
+        by_age = sorted(trees, key=lambda k: trees[k]['last_used'])
+        for key in by_age:
+            if len(trees) <= self.max_entries:
+                break
+            if self.live_refs(trees[key]):
+                continue
+            print "        Evicting cached tree '%s'" % key
+            discard_tree(os.path.join(self.cache_dir, key))
+            del trees[key]
+
+    def acquire(self, tarball_path, strip_components=1):
+        # Return the path of a read-only extracted tree for the tarball,
+        # extracting it if not yet cached; the reference is held until
+        # release() or process exit
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        key = self.tree_key(tarball_path, strip_components)
+        tree_dir = os.path.join(self.cache_dir, key)
+        with LockedFile(self.lock_path):
+            index = read_json(self.index_path, dict(trees = {}))
+            sweep_stale(self.cache_dir)
+            # Trees only appear and disappear whole, by rename; so adopt
+            # one whose index entry was lost, e.g. to a kill before
+            # write_json()
+            if os.path.isdir(tree_dir):
+                print "        Using cached tree '%s'" % tree_dir
+            else:
+                self.extract(tarball_path, strip_components, tree_dir)
+            entry = index['trees'].setdefault(key, dict(
+                    tarball = os.path.abspath(tarball_path)))
+            entry['refs'] = list(set(self.live_refs(entry) + [os.getpid()]))
+            entry['last_used'] = time.time()
+            self.evict(index)
+            write_json(self.index_path, index)
+        if not self.held:
+            atexit.register(self.release)
+        self.held.add(key)
+        return tree_dir
+
+    def release(self):
+        # Drop this process's references to all acquired trees
+        if not self.held:
+            return
+        with LockedFile(self.lock_path):
+            index = read_json(self.index_path, dict(trees = {}))
+            for key in self.held:
+                entry = index['trees'].get(key)
+                if entry is not None:
+                    entry['refs'] = [pid for pid in self.live_refs(entry)
+                                     if pid != os.getpid()]
+            write_json(self.index_path, index)
+        self.held.clear()
+
+
+class ConfigureCache(object):
+    # Memoized results of source package configure steps, such as
+    # `debian/rules debian/control`.  The key fingerprints the
+    # configured subtrees plus the step's other inputs; an entry holds
+    # a tarball of the files the step created or modified and a list
+    # of the files it deleted, replayed onto the source tree on a hit.
+    # Entries beyond `max_entries` are evicted least-recently-used first.
+    excluded_paths = ('debian/changelog',)  # Rewritten on every run
+    max_entries = 20
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stats_path = os.path.join(cache_dir, 'stats.json')
+        self.lock_path = os.path.join(cache_dir, 'lock')
+
+    def snapshot(self, tree_dir, paths):
+        # Map relative path to content digest for all files under paths
+        snap = {}
+        for top in paths:
+            for dirpath, dirnames, filenames in \
+                    os.walk(os.path.join(tree_dir, top)):
+                dirnames.sort()
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    relpath = os.path.relpath(path, tree_dir)
+                    if relpath in self.excluded_paths:
+                        continue
+                    m = md5.new()
+                    if os.path.islink(path):
+                        m.update('link:%s' % os.readlink(path))
+                    else:
+                        m.update('mode:%o:' % os.stat(path).st_mode)
+                        with open(path, 'rb') as f:
+                            m.update(f.read())
+                    snap[relpath] = m.hexdigest()
+        return snap
+
+    def fingerprint(self, snapshot, inputs):
+        m = md5.new()
+        m.update(json.dumps(inputs, sort_keys=True))
+        for relpath in sorted(snapshot):
+            m.update('%s\0%s\0' % (relpath, snapshot[relpath]))
+        return m.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def count(self, stat_name):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with LockedFile(self.lock_path):
+            stats = read_json(self.stats_path, dict(hits = 0, misses = 0))
+            stats[stat_name] += 1
+            write_json(self.stats_path, stats)
+        return stats
+
+    def evict(self):
+        # Called with the lock held
+        # Keys are plain md5sums; skip in-flight *.tmp and *.del dirs
+        entries = [e for e in os.listdir(self.cache_dir)
+                   if '.' not in e and os.path.exists(os.path.join(self.entry_dir(e),
+                                                  'manifest.json'))]
+        entries.sort(key=lambda e: os.path.getmtime(self.entry_dir(e)))
+        for key in entries[:max(0, len(entries) - self.max_entries)]:
+            print "    Evicting configure cache entry '%s'" % key
+            discard_tree(self.entry_dir(key))
+
+    def replay(self, key, tree_dir):
+        # Apply a cached entry to tree_dir; return False on a miss
+        entry_dir = self.entry_dir(key)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with LockedFile(self.lock_path):
+            manifest = read_json(os.path.join(entry_dir, 'manifest.json'))
+            if manifest is not None:
+                for relpath in manifest['deleted']:
+                    path = os.path.join(tree_dir, relpath)
+                    if os.path.lexists(path):
+                        os.remove(path)
+                tar = tarfile.open(os.path.join(entry_dir, 'files.tar'), 'r')
+                for member in tar.getmembers():
+                    path = os.path.join(tree_dir, member.name)
+                    if os.path.lexists(path):
+                        os.remove(path)
+                tar.extractall(tree_dir)
+                tar.close()
+                os.utime(entry_dir, None)  # Mark recently used
+        if manifest is None:
+            stats = self.count('misses')
+            print "    Configure cache miss (%(hits)d hits, %(misses)d misses)" \
+                % stats
+            return False
+        stats = self.count('hits')
+        print "    Configure cache hit (%(hits)d hits, %(misses)d misses)" \
+            % stats
+        print "        Replayed %d files, %d deletions from '%s'" % \
+            (len(manifest['changed']), len(manifest['deleted']), entry_dir)
+        return True
+
+    def record(self, key, tree_dir, before, after):
+        # Save the changes between two snapshots as a cache entry
+        changed = sorted(p for p in after if before.get(p) != after[p])
+        deleted = sorted(p for p in before if p not in after)
+        entry_dir = self.entry_dir(key)
+        tmp_dir = '%s.%d.tmp' % (entry_dir, os.getpid())
+        remove_tree(tmp_dir)
+        os.makedirs(tmp_dir)
+        tar = tarfile.open(os.path.join(tmp_dir, 'files.tar'), 'w')
+        for relpath in changed:
+            tar.add(os.path.join(tree_dir, relpath), arcname=relpath,
+                    recursive=False)
+        tar.close()
+        write_json(os.path.join(tmp_dir, 'manifest.json'),
+                   dict(changed = changed, deleted = deleted))
+        with LockedFile(self.lock_path):
+            # Another build may have recorded the same key meanwhile
+            discard_tree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+            self.evict()
+            sweep_stale(self.cache_dir)
+        print "    Recorded configure results in '%s'" % entry_dir
+
+
+class ScratchManager(object):
+    # Tracks the size and last use of the per-package trees in the
+    # shared tmp directory, evicting least-recently-used trees not in
+    # use by a live build to keep within a global quota and the free
+    # disk space.
+    def __init__(self, tmp_base):
+        self.tmp_base = tmp_base
+        self.index_path = os.path.join(tmp_base, '.scratch.json')
+        self.lock_path = os.path.join(tmp_base, '.scratch.lock')
+        self.quota = None      # Bytes; None = limited only by free space
+        self.wait = 0          # Seconds to wait for space before failing
+        self.wait_interval = 30
+
+    def tree_size(self, path):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for fname in dirnames + filenames:
+                size += os.lstat(os.path.join(dirpath, fname)).st_blocks * 512
+        return size
+
+    def free_space(self):
+        st = os.statvfs(self.tmp_base)
+        return st.f_bavail * st.f_frsize
+
+    def update(self, name, **kwargs):
+        if not os.path.exists(self.tmp_base):
+            os.makedirs(self.tmp_base)
+        with LockedFile(self.lock_path):
+            index = read_json(self.index_path, {})
+            if kwargs.get('remove', False):
+                index.pop(name, None)
+            else:
+                entry = index.setdefault(name, dict(size = None))
+                entry.update(kwargs)
+            write_json(self.index_path, index)
+
+    def touch(self, name):
+        # Mark a tree as in use by this process
+        self.update(name, last_used = time.time(), pid = os.getpid())
+
+    def measure(self, name):
+        path = os.path.join(self.tmp_base, name)
+        self.update(name, size = self.tree_size(path),
+                    last_used = time.time(), pid = os.getpid())
+
+    def forget(self, name):
+        self.update(name, remove = True)
+
+    def refresh(self, index):
+        # Track trees unknown to the index (e.g. from older obsprep runs)
+        # and drop entries for trees removed behind our back
+        for name in os.listdir(self.tmp_base):
+            path = os.path.join(self.tmp_base, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            entry = index.setdefault(name, dict(
+                    size = None, last_used = os.path.getmtime(path), pid = None))
+            if entry['size'] is None:
+                entry['size'] = self.tree_size(path)
+        for name in list(index):
+            if not os.path.isdir(os.path.join(self.tmp_base, name)):
+                del index[name]
+
+    def in_use(self, entry):
+        pid = entry.get('pid')
+        return pid is not None and pid != os.getpid() and pid_is_alive(pid)
+
+    def try_reserve(self, name, needed):
+        # Evict trees until `needed` bytes fit; return shortfall or 0
+        with LockedFile(self.lock_path):
+            index = read_json(self.index_path, {})
+            self.refresh(index)
+            # The tree may have been cleaned since last measured
+            path = os.path.join(self.tmp_base, name)
+            if name in index:
+                index[name]['size'] = self.tree_size(path)
+            def shortfall():
+                short = needed - self.free_space()
+                if self.quota is not None:
+                    used = sum(e['size'] for e in index.values())
+                    short = max(short, used + needed - self.quota)
+                return short
+            victims = sorted(
+                [n for n in index if n != name and not self.in_use(index[n])],
+                key=lambda n: index[n]['last_used'])
+            if shortfall() > sum(index[n]['size'] for n in victims):
+                # Evicting everything wouldn't help; leave trees alone
+                return shortfall()
+            for victim in victims:
+                if shortfall() <= 0:
+                    break
+                print "    Evicting scratch tree '%s' (%dM, unused %dh)" % \
+                    (victim, index[victim]['size']/1024/1024,
+                     (time.time() - index[victim]['last_used'])/3600)
+                remove_tree(os.path.join(self.tmp_base, victim))
+                del index[victim]
+            write_json(self.index_path, index)
+            return max(shortfall(), 0)
+
+    def reserve(self, name, needed):
+        # Make room for `needed` more bytes of scratch space for tree
+        # `name`, waiting up to `wait` seconds for other builds to free
+        # space
+        if not os.path.exists(self.tmp_base):
+            os.makedirs(self.tmp_base)
+        deadline = time.time() + self.wait
+        while True:
+            short = self.try_reserve(name, needed)
+            if short == 0:
+                return
+            if time.time() >= deadline:
+                raise OBSBuildRuntimeError(
+                    "Not enough scratch space for '%s':  need %dM, short %dM" %
+                    (name, needed/1024/1024, short/1024/1024))
+            print "    Waiting for %dM scratch space" % (short/1024/1024)
+            time.sleep(self.wait_interval)
+
+
+########################################################################
+# Upstream update checks
+########################################################################
+def run_threaded(func, items, jobs):
+    # Call func(item) for each item from up to `jobs` worker threads;
+    # return the results in item order, re-raising the first exception
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(jobs, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class HTTPCache(object):
+    # Fetches URLs with conditional requests (If-None-Match and
+    # If-Modified-Since), keeping the last response body, so repeated
+    # polls of unchanged resources cost only a 304 reply
+    user_agent = 'obsprep'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, 'lock')
+        self.stats = dict(fetched = 0, not_modified = 0)
+        self.stats_lock = threading.Lock()
+
+    def body_path(self, url):
+        return os.path.join(self.cache_dir, md5.new(url).hexdigest())
+
+    def fetch(self, url, timeout=60):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with LockedFile(self.lock_path):
+            entry = read_json(self.index_path, {}).get(url)
+        if entry is not None and not os.path.exists(self.body_path(url)):
+            entry = None
+
+        request = urllib2.Request(url, headers={'User-Agent': self.user_agent})
+        if entry is not None:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+            with self.stats_lock:
+                self.stats['not_modified'] += 1
+            with open(self.body_path(url), 'rb') as f:
+                return f.read()
+        body = response.read()
+        with self.stats_lock:
+            self.stats['fetched'] += 1
+
+        tmp_path = '%s.%d.%s.tmp' % (self.body_path(url), os.getpid(),
+                                     threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.rename(tmp_path, self.body_path(url))
+        with LockedFile(self.lock_path):
+            index = read_json(self.index_path, {})
+            index[url] = dict(
+                etag = response.info().getheader('ETag'),
+                last_modified = response.info().getheader('Last-Modified'),
+                )
+            write_json(self.index_path, index)
+        return body
+
+
+class UpstreamCheck(object):
+    # Base class for finding the latest upstream version of a package;
+    # `url` may be overridden, e.g. to point at a local stand-in
+    def __init__(self, url, pattern=None):
+        self.url = url
+        self.pattern = pattern
+
+    def with_url(self, url):
+        check = copy.copy(self)
+        check.url = url
+        return check
+
+    def current(self, pkg):
+        return pkg.upstream_version
+
+    def latest(self, http_cache, runner):
+        raise OBSBuildRuntimeError("Subclasses must override `latest()`")
+
+    def is_newer(self, latest, current):
+        return version_compare(latest, current) > 0
+
+    def latest_of(self, versions):
+        if not versions:
+            raise OBSBuildRuntimeError("No versions found at '%s'" % self.url)
+        return max(versions, key=functools.cmp_to_key(version_compare))
+
+
+class IndexCheck(UpstreamCheck):
+    # Versions from a directory index page; `pattern` has one group
+    # matching the version in file names
+    def latest(self, http_cache, runner):
+        page = http_cache.fetch(self.url)
+        return self.latest_of(set(re.findall(self.pattern, page)))
+
+
+class ReleaseListCheck(UpstreamCheck):
+    # Versions from a JSON release or tag listing, such as GitHub's
+    # /repos/<owner>/<repo>/tags; `pattern` has one group matching the
+    # version in the `key` field of each item
+    def __init__(self, url, pattern, key='name'):
+        super(ReleaseListCheck, self).__init__(url, pattern)
+        self.key = key
+
+    def latest(self, http_cache, runner):
+        versions = []
+        for item in json.loads(http_cache.fetch(self.url)):
+            match = re.match(self.pattern, item.get(self.key, ''))
+            if match:
+                versions.append(match.group(1))
+        return self.latest_of(versions)
+
+
+class GitRefCheck(UpstreamCheck):
+    # Commit of a ref in a git repository, compared with the package's
+    # abbreviated `git_rev`
+    def __init__(self, url, ref='HEAD'):
+        super(GitRefCheck, self).__init__(url)
+        self.ref = ref
+
+    def current(self, pkg):
+        return pkg.git_rev
+
+    def latest(self, http_cache, runner):
+        output = runner.check_output(('git', 'ls-remote', self.url, self.ref))
+        for line in output.splitlines():
+            sha, ref = line.split('\t', 1)
+            if ref == self.ref or self.ref == 'HEAD':
+                return sha
+        raise OBSBuildRuntimeError("Ref '%s' not found in '%s'" %
+                                   (self.ref, self.url))
+
+    def is_newer(self, latest, current):
+        return not latest.startswith(current)
+
+
+def check_updates(packages, http_cache, runner, jobs=8, url_overrides=None):
+    # Query upstream sources for all packages concurrently; return a
+    # list of (name, current, latest, status) tuples
+    def check(pkg):
+        upstream_check = pkg.upstream_check
+        if url_overrides and pkg.name in url_overrides:
+            upstream_check = upstream_check.with_url(url_overrides[pkg.name])
+        try:
+            current = upstream_check.current(pkg)
+            latest = upstream_check.latest(http_cache, runner)
+        except Exception as e:
+            return (pkg.name, None, None, 'error: %s' % e)
+        if upstream_check.is_newer(latest, current):
+            status = 'update available'
+        else:
+            status = 'up to date'
+        return (pkg.name, current, latest, status)
+
+    return run_threaded(
+        check, [p for p in packages if p.upstream_check is not None], jobs)
+
+
+########################################################################
+# Source prefetch
+########################################################################
+class BandwidthLimiter(object):
+    # Paces callers so their combined transfer rate stays under `rate`
+    # bytes per second
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + nbytes / self.rate
+            delay = self.next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Prefetcher(object):
+    # Downloads (url, path) items concurrently, with at most `per_host`
+    # connections to each host and an optional global bandwidth cap
+    chunk_size = 64*1024
+    user_agent = 'obsprep'
+
+    def __init__(self, per_host=2, bandwidth=None, timeout=300):
+        self.per_host = per_host
+        self.limiter = bandwidth and BandwidthLimiter(bandwidth)
+        self.timeout = timeout
+        self.host_slots = {}
+        self.lock = threading.Lock()
+        self.stats = dict(downloaded = 0, present = 0, linked = 0, failed = 0,
+                          bytes = 0)
+
+    def host_slot(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.lock:
+            return self.host_slots.setdefault(
+                host, threading.Semaphore(self.per_host))
+
+    def count(self, stat_name, n=1):
+        with self.lock:
+            self.stats[stat_name] += n
+
+    def download(self, item):
+        url, path = item
+        if os.path.exists(path):
+            self.count('present')
+            return
+        part_path = '%s.part' % path
+        try:
+            with self.host_slot(url):
+                print "    Downloading '%s'" % url
+                request = urllib2.Request(
+                    url, headers={'User-Agent': self.user_agent})
+                response = urllib2.urlopen(request, timeout=self.timeout)
+                received = 0
+                with open(part_path, 'wb') as f:
+                    while True:
+                        chunk = response.read(self.chunk_size)
+                        if len(chunk) == 0: break
+                        if self.limiter:
+                            self.limiter.consume(len(chunk))
+                        f.write(chunk)
+                        received += len(chunk)
+                        self.count('bytes', len(chunk))
+                # Short reads end silently rather than raising
+                length = response.info().getheader('Content-Length')
+                if length is not None and received != int(length):
+                    raise IOError("Short read:  %d of %s bytes" %
+                                  (received, length))
+            os.rename(part_path, path)
+            self.count('downloaded')
+        except (IOError, urllib2.URLError, httplib.HTTPException) as e:
+            # HTTPException, e.g. IncompleteRead, isn't an IOError
+            print "    Failed to download '%s':  %s" % (url, repr(e))
+            self.count('failed')
+        finally:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+
+    def interleave_hosts(self, items):
+        # Order items round-robin by host, so workers don't all queue
+        # up behind one host's connection limit
+        by_host = {}
+        for item in items:
+            by_host.setdefault(urlparse.urlsplit(item[0]).netloc, []).append(item)
+        queues = [by_host[h] for h in sorted(by_host)]
+        ordered = []
+        while queues:
+            ordered.extend(q.pop(0) for q in queues)
+            queues = [q for q in queues if q]
+        return ordered
+
+    def link(self, src_path, path):
+        # Hardlink a second path to an already downloaded file
+        if os.path.exists(path):
+            self.count('present')
+            return
+        if not os.path.exists(src_path):
+            return  # Download failed; already counted
+        try:
+            os.link(src_path, path)
+        except OSError:
+            shutil.copy2(src_path, path)
+        self.count('linked')
+
+    def fetch_all(self, items, jobs=8):
+        # Download each URL once, e.g. the Xenomai tarball wanted by both
+        # the xenomai and linux packages, then link its other paths
+        by_url = {}
+        for url, path in items:
+            paths = by_url.setdefault(url, [])
+            if path not in paths:
+                paths.append(path)
+        # Prefer a path that's already present as the download target
+        primary = dict((url, sorted(paths, key=os.path.exists, reverse=True)[0])
+                       for url, paths in by_url.items())
+
+        start_time = time.time()
+        run_threaded(self.download,
+                     self.interleave_hosts(sorted(primary.items())), jobs)
+        for url, paths in sorted(by_url.items()):
+            for path in paths:
+                if path != primary[url]:
+                    self.link(primary[url], path)
+        elapsed = max(time.time() - start_time, 0.001)
+        print "Prefetched %(downloaded)d files, %(present)d already present, " \
+            "%(linked)d linked, %(failed)d failed" % self.stats
+        print "    %dk in %.1fs:  %.1fk/s" % \
+            (self.stats['bytes']/1024, elapsed,
+             self.stats['bytes']/1024/elapsed)
+        return self.stats['failed'] == 0
+
+
+########################################################################
+# Source tree checks
+########################################################################
+class UnwantedBinaryScanner(object):
+    # Finds the files in a source tree's debian/ directory that make
+    # `dpkg-source -b` die with "detected N unwanted binary files",
+    # using dpkg-source's own rules:  a file is binary if it has a NUL
+    # in its first 4k, and is allowed if dropped by the default
+    # --tar-ignore or --diff-ignore patterns or listed in
+    # debian/source/include-binaries
+    binary_check_size = 4096
+    tar_ignore_globs = (
+        '*.a', '*.la', '*.o', '*.so', '.*.sw?', '*~', ',,*', '.[#~]*',
+        '.arch-ids', '.arch-inventory', '.be', '.bzr', '.bzr.backup',
+        '.bzr.tags', '.bzrignore', '.cvsignore', '.deps', '.git',
+        '.gitattributes', '.gitignore', '.gitmodules', '.gitreview', '.hg',
+        '.hgignore', '.hgsigs', '.hgtags', '.mailmap', '.mtn-ignore',
+        '.shelf', '.svn', 'CVS', 'DEADJOE', 'RCS', '_MTN', '_darcs', '{arch}',
+        )
+    diff_ignore_re = re.compile(
+        r'(?:^|/).*~$|(?:^|/)\.#.*$|(?:^|/)\..*\.sw.$|(?:^|/),,.*(?:$|/.*$)|'
+        r'(?:^|/)(?:DEADJOE|\.arch-inventory|\.(?:bzr|cvs|hg|git|mtn-)ignore)$|'
+        r'(?:^|/)(?:CVS|RCS|\.deps|\{arch\}|\.arch-ids|\.svn|'
+        r'\.hg(?:tags|sigs)?|_darcs|\.git(?:attributes|modules|review)?|'
+        r'\.mailmap|\.shelf|_MTN|\.be|\.bzr(?:\.backup|tags)?)(?:$|/.*$)')
+
+    def __init__(self, tree_dir, jobs=8):
+        self.tree_dir = tree_dir
+        self.jobs = jobs
+
+    @property
+    def include_binaries(self):
+        path = os.path.join(self.tree_dir, 'debian/source/include-binaries')
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'r') as f:
+            return set(l.strip() for l in f
+                       if l.strip() and not l.startswith('#'))
+
+    def is_ignored(self, relpath):
+        for component in relpath.split('/'):
+            for pattern in self.tar_ignore_globs:
+                if fnmatch.fnmatchcase(component, pattern):
+                    return True
+        return self.diff_ignore_re.search(relpath) is not None
+
+    def is_binary(self, path):
+        with open(path, 'rb') as f:
+            return '\0' in f.read(self.binary_check_size)
+
+    def scan(self):
+        # Return (number of files scanned, list of unwanted binary files)
+        candidates = []
+        for dirpath, dirnames, filenames in \
+                os.walk(os.path.join(self.tree_dir, 'debian')):
+            # Don't descend into ignored directories, e.g. .git
+            dirnames[:] = [d for d in dirnames if not self.is_ignored(
+                    os.path.relpath(os.path.join(dirpath, d), self.tree_dir))]
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                relpath = os.path.relpath(path, self.tree_dir)
+                if os.path.isfile(path) and not os.path.islink(path) and \
+                        not self.is_ignored(relpath):
+                    candidates.append(relpath)
+        allowed = self.include_binaries
+        binary = run_threaded(
+            lambda relpath: self.is_binary(os.path.join(self.tree_dir, relpath)),
+            candidates, self.jobs)
+        unwanted = sorted(relpath for relpath, b in zip(candidates, binary)
+                          if b and relpath not in allowed)
+        return len(candidates), unwanted
+
+
 ########################################################################
 # Abstract class
 ########################################################################
@@ -26,13 +1101,34 @@ class OBSBuild(object):
     registry = []
     dpkg_source_args = []
     git_rev = ''
+    upstream_check = None
+    configure_args = ()  # Copied per instance; configure may append
+    configure_cruft = ()
+    configure_cache_paths = ('debian',)
+    # What to do with unwanted binary files found in debian/ before
+    # running dpkg-source:  'fail', or 'clean' to remove those whose
+    # names match `unwanted_binary_clean_globs` and fail on the rest
+    unwanted_binary_policy = 'fail'
+    unwanted_binary_clean_globs = ('*.pyc', '*.pyo')
     # Hardcoded in osc.commandline.Osc.do_repourls()
     url_tmpl = 'http://download.opensuse.org/repositories/%s'
+    # Shared by all instances; configured from the command line
+    runner = ProcessRunner()
 
     dpkg_source_comp_map = dict(
         gz = 'gzip',
         bz2 = 'bzip2',
         )
+    # Typical unpacked/compressed size ratios, for when the unpacked
+    # size can't be read from the tarball
+    unpack_size_ratio_map = dict(
+        gz = 5,
+        bz2 = 6,
+        xz = 7,
+        )
+    # Shared by all instances; configured from the command line
+    scratch_quota = None
+    scratch_wait = 0
 
     class __metaclass__(type):
         def __init__(cls, name, bases, clsdict):
@@ -43,6 +1139,11 @@ class OBSBuild(object):
         self.package_dir = os.path.abspath(pac_dir)
         self.tmp_dir = os.path.normpath("%s/../tmp/%s" % (self.package_dir,
                                                           self.name))
+        self.scratch = ScratchManager(os.path.dirname(self.tmp_dir))
+        self.scratch.quota = self.scratch_quota
+        self.scratch.wait = self.scratch_wait
+        self.cache_dir = os.path.normpath("%s/../cache" % self.package_dir)
+        self.configure_args = list(self.configure_args)
         self.args = args
 
         # Set up osc object and configuration
@@ -68,6 +1169,17 @@ class OBSBuild(object):
     def package_inst(cls, pac_dir = os.getcwd(), args=None):
         return cls.package_class(pac_dir)(pac_dir, args=args)
 
+    @classmethod
+    def registered_packages(cls, packages_dir, args=None):
+        # Instances of all registered packages checked out in packages_dir
+        pkgs = []
+        for c in cls.registry:
+            pac_dir = os.path.join(packages_dir, c.name or '')
+            if c.name is None or not os.path.isdir(pac_dir):
+                continue
+            pkgs.append(c(pac_dir, args=args))
+        return pkgs
+
     def make_tmp_dir(self, subdir=None, clean=False, create=True):
         # If subdir specified, append to tmp_dir
         if subdir is None:
@@ -80,12 +1192,59 @@ class OBSBuild(object):
         # And create the directory
         if create and not os.path.exists(tmp_dir):
             os.makedirs(tmp_dir)
+        if create and clean:
+            # Don't leave the removed tree's size in the accounting
+            self.scratch.measure(self.name)
+        elif create:
+            self.scratch.touch(self.name)
         # Return tmp_dir for convenience
         return tmp_dir
 
     def remove_tmp_dir(self, subdir=None):
+        if subdir is None:
+            self.scratch.forget(self.name)
         return self.make_tmp_dir(subdir=subdir, clean=True, create=False)
 
+    def estimate_unpacked_size(self, tarball_path):
+        # Uncompressed size of a tarball, read from the gzip trailer or
+        # xz index where possible, else estimated from the compressed size
+        size = os.path.getsize(tarball_path)
+        ext = tarball_path.rsplit('.', 1)[-1]
+        if ext == 'gz':
+            with open(tarball_path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                isize = struct.unpack('<I', f.read(4))[0]
+            if isize >= size:  # Else > 4G, stored modulo 2^32
+                return isize
+        elif ext == 'xz':
+            output = self.runner.check_output(
+                ('xz', '--robot', '--list', tarball_path))
+            for line in output.splitlines():
+                fields = line.split('\t')
+                if fields[0] == 'totals':
+                    return int(fields[4])
+        return size * self.unpack_size_ratio_map.get(ext, 10)
+
+    @property
+    def digests(self):
+        if not hasattr(self, '_digests'):
+            self._digests = DigestMemo(self.cache_dir)
+        return self._digests
+
+    @property
+    def tree_cache(self):
+        if not hasattr(self, '_tree_cache'):
+            self._tree_cache = ExtractedTreeCache(
+                os.path.join(self.cache_dir, 'trees'), self.runner)
+        return self._tree_cache
+
+    @property
+    def configure_cache(self):
+        if not hasattr(self, '_configure_cache'):
+            self._configure_cache = ConfigureCache(
+                os.path.join(self.cache_dir, 'configure'))
+        return self._configure_cache
+
 
     ########################################################################
     # Tarball operations
@@ -129,6 +1288,10 @@ class OBSBuild(object):
     def debian_tarball_size(self):
         return  os.path.getsize(self.debian_tarball_path)
 
+    def prefetch_items(self):
+        # (url, path) of every remote input to the build
+        return [(self.debian_tarball_url, self.debian_tarball_path)]
+
     def debian_tarball_download(self):
         print "Debian orig tarball '%s':" % self.debian_tarball_filename
 
@@ -235,16 +1398,19 @@ class OBSBuild(object):
     def debian_package_source_unpack(self):
         # Extract debian original source tarball
         print "Unpacking original source tarball"
+        self.scratch.reserve(
+            self.name, self.estimate_unpacked_size(self.debian_tarball_path))
         tmp_dir = self.make_tmp_dir(subdir='source_tree', clean=True)
         tar_cmd = ('tar', 'xCf', tmp_dir, self.debian_tarball_path,
                    '--strip-components=%d' % self.tarball_strip_components,
                    )
         print "    Running command:  %s" % ' '.join(tar_cmd)
-        tar_p = subprocess.Popen(tar_cmd)
-        if tar_p.wait() != 0:
+        tar_p = self.runner.start(tar_cmd)
+        if self.runner.wait(tar_p) != 0:
             raise OBSBuildRuntimeError(
                 "Failed to extract tarball from '%s' (result %d)" %
                 (self.debian_tarball_filename, tar_p.poll()))
+        self.scratch.measure(self.name)
 
     def debian_package_source_debianize(self):
         print "Debianizing source tree from git repository"
@@ -253,16 +1419,23 @@ class OBSBuild(object):
         tmp_dir = self.make_tmp_dir(subdir='source_tree')
         tar_cmd = ('tar', 'xCf', tmp_dir, '-')
         print "    Running (un)tar command:  %s" % ' '.join(tar_cmd)
-        tar_p = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE)
+        tar_p = self.runner.start(tar_cmd, stdin=subprocess.PIPE)
         # Create tarball of git tree prefixed with debian/
         git_cmd = ('git', 'archive', '--prefix=debian/', 'HEAD')
         print "    Piping 'git archive' command to (un)tar:  %s" % \
             ' '.join(git_cmd)
-        git_p = subprocess.Popen(git_cmd, stdout=tar_p.stdin,
-                                 cwd=self.package_dir)
+        git_p = self.runner.start(git_cmd, stdout=tar_p.stdin,
+                                  cwd=self.package_dir)
         # Reap processes and check result
-        tar_p.communicate()
-        git_p.communicate()
+        tar_p.stdin.close()
+        try:
+            self.runner.wait(git_p)
+        except:
+            # Don't leave tar running after a git timeout
+            self.runner.kill(tar_p)
+            raise
+        finally:
+            self.runner.wait(tar_p)
         if tar_p.poll() or git_p.poll():
             raise OBSBuildRuntimeError(
                 "'git archive | tar x' exited non-zero:  %d/%d" % \
@@ -286,13 +1459,94 @@ class OBSBuild(object):
         # configuration step
         pass
 
+    def configure_cache_inputs(self, config_cmd):
+        # Inputs to the configure step besides the configured subtrees;
+        # subclasses whose configure reads other state extend this
+        return dict(
+            config_cmd = list(config_cmd),
+            configure_args = list(self.configure_args),
+            upstream_version = self.upstream_version,
+            version = str(self.changelog.version),
+            configure_cruft = list(self.configure_cruft),
+            # Cleaned binaries are recorded as deletions
+            binary_policy = self.binary_policy,
+            binary_clean_globs = list(self.unwanted_binary_clean_globs),
+            )
+
+    def debian_package_source_configure_cached(self, config_cmd, check=True):
+        # Run a configure command in the source tree and remove
+        # `configure_cruft`, or replay the results of an earlier run
+        # with identical inputs
+        tmp_dir = self.make_tmp_dir(subdir='source_tree')
+        cache = self.configure_cache
+        before = cache.snapshot(tmp_dir, self.configure_cache_paths)
+        key = cache.fingerprint(before, self.configure_cache_inputs(config_cmd))
+        if cache.replay(key, tmp_dir):
+            return
+
+        print "    Running command:  %s" % ' '.join(config_cmd)
+        config_p = self.runner.start(config_cmd, cwd=tmp_dir)
+        if self.runner.wait(config_p) and check:
+            raise OBSBuildRuntimeError("`%s` returned %d" %
+                                       (' '.join(config_cmd), config_p.poll()))
+        # Remove cruft causing dpkg-source errors
+        #     error: detected 4 unwanted binary files
+        for path in self.configure_cruft:
+            if os.path.lexists(os.path.join(tmp_dir, path)):
+                os.remove(os.path.join(tmp_dir, path))
+        # ...and any new cruft, so the cache records its removal too
+        self.debian_package_scan_binaries()
+
+        after = cache.snapshot(tmp_dir, self.configure_cache_paths)
+        cache.record(key, tmp_dir, before, after)
+
+    @property
+    def binary_policy(self):
+        return getattr(self.args, 'binary_policy', None) or \
+            self.unwanted_binary_policy
+
+    def debian_package_scan_binaries(self):
+        # Pre-flight check for binary files dpkg-source would reject,
+        # handled according to `unwanted_binary_policy`
+        if '--format=3.0 (native)' in self.dpkg_source_args:
+            return  # Native packages are tarred up whole
+        print "    Scanning debian/ for unwanted binary files"
+        scanner = UnwantedBinaryScanner(
+            self.make_tmp_dir(subdir='source_tree'),
+            jobs = getattr(self.args, 'jobs', 8))
+        scanned, unwanted = scanner.scan()
+        print "        Scanned %d files, %d unwanted binary files" % \
+            (scanned, len(unwanted))
+        if not unwanted:
+            return
+        remaining = []
+        for relpath in unwanted:
+            cleanable = self.binary_policy == 'clean' and [
+                g for g in self.unwanted_binary_clean_globs
+                if fnmatch.fnmatchcase(os.path.basename(relpath), g)]
+            if cleanable:
+                print "        Removing:  %s" % relpath
+                os.remove(os.path.join(scanner.tree_dir, relpath))
+            else:
+                print "        Unwanted:  %s" % relpath
+                remaining.append(relpath)
+        if remaining:
+            raise OBSBuildRuntimeError(
+                "Found %d unwanted binary files in debian/; remove them "
+                "or add them to debian/source/include-binaries" %
+                len(remaining))
+
     def debian_package_dpkg_source(self):
         print "Building Debian source package"
 
-        # Remove existing debianization and .dsc files
+        # Fail before dpkg-source spends minutes scanning the tree
+        self.debian_package_scan_binaries()
+
+        # Remove existing debianization, .dsc and fingerprint files
         files = (glob.glob("%s_*.debian.tar.%s" %
                            (self.name, self.compression_ext)) +
-                 glob.glob("%s_*.dsc" % self.name))
+                 glob.glob("%s_*.dsc" % self.name) +
+                 glob.glob(".%s_*.dsc.fingerprint" % self.name))
         for f in files:
             print "    Removing existing file '%s'" % f
             os.unlink(f)
@@ -306,8 +1560,7 @@ class OBSBuild(object):
                  '-b', tmp_dir]
             )
         print "    Running command:  %s" % ' '.join(dpkg_cmd)
-        dpkg_p = subprocess.Popen(dpkg_cmd, cwd=self.package_dir)
-        if dpkg_p.wait():
+        if self.runner.run(dpkg_cmd, cwd=self.package_dir):
             raise OBSBuildRuntimeError("`dpkg-source` failed")
 
     def debian_package_source_tree(self):
@@ -321,14 +1574,106 @@ class OBSBuild(object):
         self.debian_package_source_debianize()
         self.debian_package_source_configure()
 
+    ########################################################################
+    # Build fingerprint operations
+    ########################################################################
+    def build_fingerprint_inputs(self):
+        # Everything the source package build depends on; subclasses
+        # with extra inputs extend this
+        inputs = dict(
+            name = self.name,
+            upstream_version = self.upstream_version,
+            osc_rev = self.osc_rev,
+            git_rev = self.git_rev,
+            dpkg_source_args = self.dpkg_source_args,
+            compression_ext = self.compression_ext,
+            debian_compression_ext = self.debian_compression_ext,
+            configure_args = list(self.configure_args),
+            configure_cruft = list(self.configure_cruft),
+            obsprep_md5sum = self.digests.md5sum(
+                os.path.splitext(os.path.abspath(__file__))[0] + '.py'),
+            dpkg_source_version = self.runner.check_output(
+                ('dpkg-source', '--version')).splitlines()[0],
+            )
+        with open(os.devnull, 'w') as devnull:
+            try:
+                inputs['git_tree'] = self.runner.check_output(
+                    ('git', 'rev-parse', 'HEAD^{tree}'),
+                    cwd=self.package_dir, stderr=devnull).strip()
+            except OBSBuildRuntimeError:
+                # Not debianized from git
+                pass
+        if self.debian_tarball_is_downloaded:
+            inputs['orig_tarball_md5sum'] = \
+                self.digests.md5sum(self.debian_tarball_path)
+        return inputs
+
+    def build_fingerprint(self, inputs=None):
+        if inputs is None:
+            inputs = self.build_fingerprint_inputs()
+        return md5.new(json.dumps(inputs, sort_keys=True)).hexdigest(), inputs
+
+    @property
+    def debian_package_dsc_files(self):
+        return glob.glob(os.path.join(self.package_dir, "%s_*.dsc" % self.name))
+
+    def fingerprint_path(self, dsc_path):
+        # Hidden file, so `osc addremove` ignores it
+        dirname, basename = os.path.split(dsc_path)
+        return os.path.join(dirname, '.%s.fingerprint' % basename)
+
+    def build_is_up_to_date(self, fingerprint):
+        # True if the single existing .dsc was built with this fingerprint
+        # and all the files it lists still exist
+        dsc_files = self.debian_package_dsc_files
+        if len(dsc_files) != 1:
+            return False
+        saved = read_json(self.fingerprint_path(dsc_files[0]))
+        if saved is None or saved['fingerprint'] != fingerprint:
+            return False
+        with open(dsc_files[0], 'r') as f:
+            dsc = deb822.Dsc(f)
+        for entry in dsc['Files']:
+            if not os.path.exists(
+                os.path.join(self.package_dir, entry['name'])):
+                return False
+        return True
+
+    def build_fingerprint_write(self, inputs):
+        # Write the fingerprint of the inputs computed before the build,
+        # so build steps changing instance state (e.g. configure_args)
+        # don't make it differ from the next run's
+        dsc_files = self.debian_package_dsc_files
+        if len(dsc_files) != 1:
+            print "    Not writing build fingerprint:  %d .dsc files found" % \
+                len(dsc_files)
+            return
+        inputs = dict(inputs)
+        # The orig tarball may have been downloaded meanwhile
+        if self.debian_tarball_is_downloaded:
+            inputs['orig_tarball_md5sum'] = \
+                self.digests.md5sum(self.debian_tarball_path)
+        fingerprint, inputs = self.build_fingerprint(inputs)
+        path = self.fingerprint_path(dsc_files[0])
+        write_json(path, dict(fingerprint = fingerprint, inputs = inputs))
+        print "    Wrote build fingerprint to '%s'" % path
+
     def debian_package_source_build(self):
+        fingerprint, inputs = self.build_fingerprint()
+        if not self.args.force and self.build_is_up_to_date(fingerprint):
+            print "Source package is up to date; use --force to rebuild"
+            return
+
         self.debian_package_source_tree()
 
         self.debian_package_dpkg_source()
+        self.build_fingerprint_write(inputs)
 
         # Clean up
         if not self.args.nocleanup:
             self.remove_tmp_dir()
+        else:
+            self.scratch.measure(self.name)
 
 
 class PackageRebuildOBSBuild(OBSBuild):
@@ -394,6 +1739,13 @@ class PackageRebuildOBSBuild(OBSBuild):
         return os.path.join(self.package_dir,
                             self.debian_package_debianization_tarball_name)
 
+    def prefetch_items(self):
+        return super(PackageRebuildOBSBuild, self).prefetch_items() + [
+            (self.debian_package_debianization_tarball_url,
+             self.debian_package_debianization_tarball_path),
+            (self.debian_package_dsc_url, self.debian_package_dsc_path),
+            ]
+
     def debian_package_dpkg_source(self):
         print "Fetch Debianization tarball"
         if os.path.exists(self.debian_package_debianization_tarball_path):
@@ -438,6 +1790,9 @@ class NoSourcePackageOBSBuild(OBSBuild):
         # All sources in this directory
         pass
 
+    def prefetch_items(self):
+        return []
+
     def debian_package_source_unpack(self):
         # All sources in this directory
         pass
@@ -460,6 +1815,9 @@ class XenomaiOBSBuild(OBSBuild):
     compression_ext = 'bz2'
     source_tarball_url_format = \
         "http://download.gna.org/xenomai/stable/xenomai-%(rev)s.tar.%(comp)s"
+    upstream_check = IndexCheck(
+        'http://download.gna.org/xenomai/stable/',
+        r'xenomai-([0-9][0-9.]*[0-9])\.tar\.bz2')
     name = 'xenomai'
 
 
@@ -470,6 +1828,8 @@ class RTAIOBSBuild(OBSBuild):
     source_tarball_url_format = \
         "https://github.com/shabbyx/rtai/archive/%(git)s.tar.%(comp)s"
     upstream_version_re = re.compile(r'(?P<rel>.*)\.(?P<gitrev>[^.]*)')
+    upstream_check = GitRefCheck(
+        'https://github.com/shabbyx/rtai.git', 'refs/heads/master')
     name = 'rtai'
 
     @property
@@ -486,24 +1846,15 @@ class LinuxToolsOBSBuild(OBSBuild):
         ("https://www.kernel.org/pub/linux/kernel/v3.x/"
          "linux-%(rev)s.tar.%(comp)s")
     compression_ext = 'xz'
-    configure_cruft = (
-        'debian/lib/python/debian_linux/debian.pyc',
-        'debian/lib/python/debian_linux/gencontrol.pyc',
-        'debian/lib/python/debian_linux/utils.pyc',
-        'debian/lib/python/debian_linux/__init__.pyc',
-        )
+    # gencontrol leaves *.pyc files that dpkg-source rejects
+    unwanted_binary_policy = 'clean'
     name = 'linux-tools'
 
     def debian_package_source_configure(self):
         # Configure source package
         config_cmd = ('debian/rules', 'debian/control')
-        tmp_dir = self.make_tmp_dir(subdir='source_tree')
-        config_p = subprocess.Popen(config_cmd, cwd=tmp_dir)
-        config_p.wait()  # Always fails
-        # Remove cruft causing dpkg-source errors
-        #     error: detected 4 unwanted binary files
-        for path in self.configure_cruft:
-            os.remove(os.path.join(tmp_dir, path))
+        # Always fails
+        self.debian_package_source_configure_cached(config_cmd, check=False)
         print "Configured source package"
 
 ########################################################################
@@ -514,38 +1865,48 @@ class LinuxOBSBuild(OBSBuild):
         ("https://www.kernel.org/pub/linux/kernel/v3.x/"
          "linux-%(rev)s.tar.%(comp)s")
     compression_ext = 'xz'
-    configure_cruft = (
-        'debian/lib/python/debian_linux/debian.pyc',
-        'debian/lib/python/debian_linux/gencontrol.pyc',
-        'debian/lib/python/debian_linux/utils.pyc',
-        'debian/lib/python/debian_linux/__init__.pyc',
-        'debian/lib/python/debian_linux/config.pyc',
-        )
+    # gencontrol leaves *.pyc files that dpkg-source rejects
+    unwanted_binary_policy = 'clean'
     name = 'linux'
     rtai_hal_patch_glob_pat = \
-        ('../tmp/linux/rtai_source/base/arch/x86/patches/'
-         'hal-linux-%s-x86-*.patch')
+        'base/arch/x86/patches/hal-linux-%s-x86-*.patch'
     xenomai_tarball_glob = '../xenomai/xenomai-*.tar.bz2'
-    configure_args = []
+
+    def prefetch_items(self):
+        # Also the Xenomai and RTAI tarballs unpacked by configure
+        items = super(LinuxOBSBuild, self).prefetch_items()
+        xenomai_dir = os.path.join(self.package_dir, '..', 'xenomai')
+        if os.path.isdir(xenomai_dir):
+            xenomai_pkg = XenomaiOBSBuild(xenomai_dir)
+            items.append((xenomai_pkg.debian_tarball_url, os.path.join(
+                        xenomai_dir, 'xenomai-%s.tar.bz2' %
+                        xenomai_pkg.upstream_version)))
+        rtai_dir = os.path.join(self.package_dir, '..', 'rtai')
+        if os.path.isdir(rtai_dir):
+            items.extend(RTAIOBSBuild(rtai_dir).prefetch_items())
+        return items
+
+    def build_fingerprint_inputs(self):
+        inputs = super(LinuxOBSBuild, self).build_fingerprint_inputs()
+        inputs['xenomai_tarball_md5sums'] = sorted(
+            self.digests.md5sum(p) for p in glob.glob(self.xenomai_tarball_glob))
+        rtai_tarball_path = self.package_inst('../rtai').debian_tarball_path
+        if os.path.exists(rtai_tarball_path):
+            inputs['rtai_tarball_md5sum'] = self.digests.md5sum(rtai_tarball_path)
+        return inputs
 
     def debian_package_source_unpack_rtai(self):
-        # Unpack RTAI tarball in tmp/linux/rtai_source
+        # Unpack RTAI tarball in the shared extracted-tree cache
         print "    Unpacking RTAI tarball for hal patch"
         rtai_pkg = self.package_inst('../rtai')
         rtai_tarball_path = rtai_pkg.debian_tarball_path
-        rtai_tmp_dir = self.make_tmp_dir(subdir='rtai_source', clean=True)
-        tar_cmd = ('tar', 'xCf', rtai_tmp_dir, rtai_tarball_path,
-                   '--strip-components=1')
-        print "        Running command:  %s" % ' '.join(tar_cmd)
-        tar_p = subprocess.Popen(tar_cmd)
-        if tar_p.wait() != 0:
-            raise OBSBuildRuntimeError("Extract tarball '%s' into '%s' failed" %
-                                       (rtai_tarball_path, rtai_tmp_dir))
+        rtai_tree_dir = self.tree_cache.acquire(rtai_tarball_path)
 
         print "    Locating RTAI hal patch"
         patch_re = re.compile(r'.*/hal-linux-%s-x86-[0-9]+.patch$' %
                               self.upstream_version)
-        patch_glob = self.rtai_hal_patch_glob_pat % self.upstream_version
+        patch_glob = os.path.join(
+            rtai_tree_dir, self.rtai_hal_patch_glob_pat % self.upstream_version)
         for p in glob.glob(patch_glob):
             match = patch_re.match(p)
             if match is not None:
@@ -560,22 +1921,15 @@ class LinuxOBSBuild(OBSBuild):
         print "        Found RTAI hal patch: %s"  % rtai_hal_patch
 
     def debian_package_source_unpack_xenomai(self):
-        # Unpack xenomai tarball in tmp/linux/xenomai_source
+        # Unpack xenomai tarball in the shared extracted-tree cache
         print "    Unpacking Xenomai tarball for patch generation"
         files = glob.glob(self.xenomai_tarball_glob)
         if len(files) != 1:
             raise OBSBuildRuntimeError("%d files matched by glob '%s'" %
                                        (len(files), self.xenomai_tarball_glob))
         xenomai_tarball_path = files[0]
-        xenomai_tmp_dir = self.make_tmp_dir(subdir='xenomai_source', clean=True)
-        tar_cmd = ('tar', 'xCf', xenomai_tmp_dir, xenomai_tarball_path,
-                   '--strip-components=1')
-        print "        Running command:  %s" % ' '.join(tar_cmd)
-        tar_p = subprocess.Popen(tar_cmd)
-        if tar_p.wait() != 0:
-            raise OBSBuildRuntimeError("Extract tarball '%s' into '%s' failed" %
-                                       (xenomai_tarball_path, xenomai_tmp_dir))
-        self.configure_args.append('XENO_SRCDIR=%s' % xenomai_tmp_dir)
+        xenomai_tree_dir = self.tree_cache.acquire(xenomai_tarball_path)
+        self.configure_args.append('XENO_SRCDIR=%s' % xenomai_tree_dir)
 
     def debian_package_source_configure(self):
         print "Configuring Debian source package"
@@ -586,18 +1940,9 @@ class LinuxOBSBuild(OBSBuild):
         self.debian_package_source_unpack_rtai()
 
         # Configure source package
-        tmp_dir = self.make_tmp_dir(subdir='source_tree')
         config_cmd = ['debian/rules', 'debian/control', 'NOFAIL=true'] + \
             self.configure_args
-        print "    Running command:  %s" % ' '.join(config_cmd)
-        config_p = subprocess.Popen(config_cmd, cwd = tmp_dir)
-        if config_p.wait():
-            raise OBSBuildRuntimeError("`%s` returned %d" %
-                                       (' '.join(config_cmd), config_p.poll()))
-        # Remove cruft causing dpkg-source errors
-        #     error: detected 4 unwanted binary files
-        for path in self.configure_cruft:
-            os.remove(os.path.join(tmp_dir, path))
+        self.debian_package_source_configure_cached(config_cmd)
 
 
 ########################################################################
@@ -607,11 +1952,19 @@ class LinuxLatestOBSBuild(NoSourcePackageOBSBuild):
     name = 'linux-latest'
     linux_subver_re = re.compile(r'^([0-9.]+)\.([0-9]+)$')
 
-    def debian_package_source_configure(self):
-        print "Configuring Debian source package"
+    def build_fingerprint_inputs(self):
+        inputs = super(LinuxLatestOBSBuild, self).build_fingerprint_inputs()
+        linux_pkg = self.package_inst('../linux')
+        inputs['linux_upstream_version'] = linux_pkg.upstream_version
+        inputs['linux_defines_md5sum'] = self.digests.md5sum(
+            "%s/config/defines" % linux_pkg.package_dir)
+        inputs.update(self.linux_support_inputs())
+        return inputs
 
-        # Ensure the correct linux-support pkg is installed
-        print "    Checking for correct linux-support package"
+    @property
+    def linux_support_package(self):
+        # Name of the linux-support package for ../linux, e.g.
+        # linux-support-3.8-1
         linux_pkg = self.package_inst('../linux')
 
         # Get linux sub-version, e.g. 3.8, without minor version
@@ -635,22 +1988,48 @@ class LinuxLatestOBSBuild(NoSourcePackageOBSBuild):
                 raise OBSBuildRuntimeError(
                     "Unable to determine linux package abiname")
 
-        # Check for package
-        linux_support = 'linux-support-%s-%s' % (linux_subversion, abiname)
+        return 'linux-support-%s-%s' % (linux_subversion, abiname)
+
+    def linux_support_inputs(self):
+        # `debian/rules debian/control` reads the installed linux-support;
+        # a missing package is reported by the configure step's check
+        linux_support = self.linux_support_package
+        with open(os.devnull, 'w') as devnull:
+            try:
+                version = self.runner.check_output(
+                    ('dpkg-query', '-W', '-f=${Version}', linux_support),
+                    stderr=devnull)
+            except OBSBuildRuntimeError:
+                version = None
+        return dict(
+            linux_support = linux_support,
+            linux_support_version = version,
+            )
+
+    def configure_cache_inputs(self, config_cmd):
+        inputs = super(LinuxLatestOBSBuild, self).configure_cache_inputs(
+            config_cmd)
+        inputs.update(self.linux_support_inputs())
+        return inputs
+
+    def debian_package_source_configure(self):
+        print "Configuring Debian source package"
+
+        # Ensure the correct linux-support pkg is installed
+        print "    Checking for correct linux-support package"
+        linux_support = self.linux_support_package
         print "    Checking for package '%s'" % linux_support
         dpkg_cmd = ('dpkg-query', '-W', linux_support)
         print "        Running command:  %s" % ' '.join(dpkg_cmd)
-        dpkg_p = subprocess.Popen(dpkg_cmd)
-        if dpkg_p.wait():
+        if self.runner.run(dpkg_cmd):
             raise OBSBuildRuntimeError(
                 "Unable to detect installed package '%s'" % linux_support)
 
         # Configure source package
         print "    Configuring source package"
         config_cmd = ('debian/rules', 'debian/control')
-        tmp_dir = self.make_tmp_dir(subdir='source_tree')
-        config_p = subprocess.Popen(config_cmd, cwd = tmp_dir)
-        config_p.communicate()  # Command always fails; don't check result
+        # Command always fails; don't check result
+        self.debian_package_source_configure_cached(config_cmd, check=False)
 
 
 ########################################################################
@@ -660,6 +2039,9 @@ class LibSodiumOBSBuild(OBSBuild):
     source_tarball_url_format = \
         ("https://download.libsodium.org/libsodium/releases/"
          "libsodium-%(rev)s.tar.%(comp)s")
+    upstream_check = IndexCheck(
+        'https://download.libsodium.org/libsodium/releases/',
+        r'libsodium-([0-9][0-9.]*[0-9])\.tar\.gz')
     name = 'libsodium'
 
 
@@ -669,6 +2051,8 @@ class LibSodiumOBSBuild(OBSBuild):
 class ZeroMQ4OBSBuild(OBSBuild):
     source_tarball_url_format = \
         "http://download.zeromq.org/zeromq-%(rev)s.tar.%(comp)s"
+    upstream_check = IndexCheck(
+        'http://download.zeromq.org/', r'zeromq-(4\.[0-9.]*[0-9])\.tar\.gz')
     name = 'zeromq4'
 
 
@@ -683,6 +2067,8 @@ class CythonOBSBuild(PackageRebuildOBSBuild):
         '%s/cython_%%(rev)s.orig.tar.%%(comp)s' % base_url
     debianization_tarball_url_format = '%s/%%(debzn_tb)s' % base_url
     debian_dsc_url_format = '%s/%%(dsc)s' % base_url
+    upstream_check = IndexCheck(
+        '%s/' % base_url, r'cython_([^_]+)\.orig\.tar\.gz')
     name = 'cython'
 
         
@@ -699,6 +2085,8 @@ class DHPythonOBSBuild(PackageRebuildOBSBuild):
         '%s/dh-python_%%(rev)s.orig.tar.%%(comp)s' % base_url
     debianization_tarball_url_format = '%s/%%(debzn_tb)s' % base_url
     debian_dsc_url_format = '%s/%%(dsc)s' % base_url
+    upstream_check = IndexCheck(
+        '%s/' % base_url, r'dh-python_([^_]+)\.orig\.tar\.xz')
     name = 'dh-python'
 
         
@@ -708,6 +2096,8 @@ class DHPythonOBSBuild(PackageRebuildOBSBuild):
 class PyZMQOBSBuild(OBSBuild):
     source_tarball_url_format = \
         "https://github.com/zeromq/pyzmq/archive/v%(rev)s.tar.%(comp)s"
+    upstream_check = ReleaseListCheck(
+        'https://api.github.com/repos/zeromq/pyzmq/tags', r'^v([0-9.]+)$')
     name = 'pyzmq'
 
 
@@ -717,6 +2107,8 @@ class PyZMQOBSBuild(OBSBuild):
 class CZMQOBSBuild(OBSBuild):
     source_tarball_url_format = \
         "http://download.zeromq.org/czmq-%(rev)s.tar.%(comp)s"
+    upstream_check = IndexCheck(
+        'http://download.zeromq.org/', r'czmq-([0-9][0-9.]*[0-9])\.tar\.gz')
     name = 'czmq'
 
 
@@ -728,6 +2120,8 @@ class LibwebsocketsOBSBuild(OBSBuild):
     source_tarball_url_format = \
         ("http://git.libwebsockets.org/cgi-bin/cgit/libwebsockets/snapshot/" \
              "libwebsockets-%s.tar.gz" % git_rev)
+    upstream_check = GitRefCheck(
+        'git://git.libwebsockets.org/libwebsockets', 'refs/heads/master')
     name = 'libwebsockets'
 
 
@@ -738,6 +2132,9 @@ class JanssonOBSBuild(OBSBuild):
     compression_ext = 'bz2'
     source_tarball_url_format = \
         "http://www.digip.org/jansson/releases/jansson-%(rev)s.tar.%(comp)s"
+    upstream_check = IndexCheck(
+        'http://www.digip.org/jansson/releases/',
+        r'jansson-([0-9][0-9.]*[0-9])\.tar\.bz2')
     name = 'jansson'
 
 
@@ -748,6 +2145,9 @@ class PythonPyFTPDLibOBSBuild(OBSBuild):
     source_tarball_url_format = \
         ("https://github.com/giampaolo/pyftpdlib/archive/" \
              "release-%(rev)s.tar.%(comp)s")
+    upstream_check = ReleaseListCheck(
+        'https://api.github.com/repos/giampaolo/pyftpdlib/tags',
+        r'^release-([0-9.]+)$')
     name = 'python-pyftpdlib'
 
 
@@ -783,10 +2183,12 @@ class MachinekitOBSBuild(NativePackageOBSBuild):
     #     "https://github.com/machinekit/machinekit/archive/%(git)s.tar.%(comp)s"
     source_tarball_url_format = \
         "https://github.com/zultron/machinekit/archive/%(git)s.tar.%(comp)s"
-    git_rev = '7468d44d'  # FIXME this should come from github
+    git_rev = '7468d44d'  # Pinned; `--check-updates` reports newer commits
     update_num = 10  # Bump this when git_rev changes for upstream update
     upstream_version = '0.2.%d.%s' % (update_num, git_rev)
     upstream_version_re = re.compile(r'(?P<rel>.*)\.(?P<gitrev>[^.]*)')
+    upstream_check = GitRefCheck(
+        'https://github.com/zultron/machinekit.git', 'refs/heads/master')
     name = 'machinekit'
     dpkg_source_args = ['--format=3.0 (native)']
     linux_package_abiver = '3.8-1'
@@ -802,14 +2204,10 @@ class MachinekitOBSBuild(NativePackageOBSBuild):
             '-X', self.linux_package_abiver,
             '-R', self.linux_package_abiver,
             )
-        tmp_dir = self.make_tmp_dir(subdir='source_tree')
-        print "    Running command:  %s" % ' '.join(config_cmd)
-        config_p = subprocess.Popen(config_cmd, cwd=tmp_dir)
-        if config_p.wait() != 0:
-            raise OBSBuildRuntimeError(
-                "Unable to configure machinekit package")
-            
+        self.debian_package_source_configure_cached(config_cmd)
+
         # Copy temp changelog into tmpdir
+        tmp_dir = self.make_tmp_dir(subdir='source_tree')
         changelog_file = os.path.join(tmp_dir, 'debian/changelog')
         print "    Writing debian changelog to %s" % changelog_file
         self.debian_changelog_write(changelog_file)
@@ -821,6 +2219,23 @@ class MachinekitOBSBuild(NativePackageOBSBuild):
 ########################################################################
 # main()
 ########################################################################
+def parse_size(size):
+    # '20G' -> 21474836480
+    size_units = dict(K = 1024, M = 1024**2, G = 1024**3)
+    size = size.upper()
+    if size[-1:] in size_units:
+        return int(float(size[:-1]) * size_units[size[-1]])
+    return int(size)
+
+def parse_tool_timeout(value):
+    # 'dpkg-source=3600' -> ('dpkg-source', 3600.0)
+    try:
+        tool, timeout = value.split('=', 1)
+        return tool, float(timeout)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected TOOL=SECONDS, got '%s'" % value)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Prepare Debian packages for OBS build')
@@ -830,19 +2245,107 @@ if __name__ == '__main__':
                         help='Build Debian package from source tree')
     parser.add_argument('--nocleanup', '-n', action='store_true',
                         help='Do not clean source tree after build')
+    parser.add_argument('--check-updates', action='store_true',
+                        help='Report packages with newer upstream versions')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Download the sources of all packages')
+    parser.add_argument('--packages-dir', default='..',
+                        help='Directory of package checkouts for '
+                        '--check-updates and --prefetch (default ..)')
+    parser.add_argument('--upstream-url', action='append', default=[],
+                        metavar='NAME=URL',
+                        help='Check package NAME against URL instead of its '
+                        'usual upstream; may be repeated')
+    parser.add_argument('--jobs', '-j', type=int, default=8,
+                        help='Number of concurrent upstream queries, '
+                        'downloads or binary file scans')
+    parser.add_argument('--per-host', type=int, default=2,
+                        help='Maximum concurrent downloads from one host')
+    parser.add_argument('--bandwidth', metavar='RATE',
+                        help='Cap total download rate at RATE bytes/second '
+                        '(suffixes K, M, G)')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='Rebuild even if the source package is up to '
+                        'date')
+    parser.add_argument('--binary-policy', choices=('fail', 'clean'),
+                        help='On finding unwanted binary files in debian/, '
+                        'fail, or remove those matching the package\'s '
+                        'clean globs, e.g. *.pyc (default per package)')
+    parser.add_argument('--scratch-quota', metavar='SIZE',
+                        help='Evict least-recently-used trees in ../tmp to '
+                        'keep it under SIZE bytes (suffixes K, M, G)')
+    parser.add_argument('--scratch-wait', type=float, default=0,
+                        metavar='SECONDS',
+                        help='Wait up to SECONDS for other builds to free '
+                        'scratch space before failing')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Kill external tools running longer than '
+                        'TIMEOUT seconds')
+    parser.add_argument('--tool-timeout', action='append', default=[],
+                        type=parse_tool_timeout,
+                        metavar='TOOL=TIMEOUT',
+                        help='Per-tool timeout overriding --timeout, e.g. '
+                        'dpkg-source=3600; may be repeated')
+    parser.add_argument('--log-dir',
+                        help='Log external tool output to files in LOG_DIR')
+    parser.add_argument('--metrics-dir',
+                        help='Write external tool resource usage to '
+                        'Prometheus textfile and JSON files in METRICS_DIR')
 
     args = parser.parse_args()
 
+    OBSBuild.runner.timeout = args.timeout
+    OBSBuild.runner.log_dir = args.log_dir
+    for tool, timeout in args.tool_timeout:
+        OBSBuild.runner.timeouts[tool] = timeout
+
+    if args.scratch_quota is not None:
+        OBSBuild.scratch_quota = parse_size(args.scratch_quota)
+    OBSBuild.scratch_wait = args.scratch_wait
+
+    if args.check_updates:
+        packages = OBSBuild.registered_packages(args.packages_dir, args=args)
+        http_cache = HTTPCache(os.path.join(args.packages_dir, 'cache', 'http'))
+        url_overrides = dict(u.split('=', 1) for u in args.upstream_url)
+        print "Checking %d packages for upstream updates" % len(packages)
+        results = check_updates(packages, http_cache, OBSBuild.runner,
+                                jobs=args.jobs, url_overrides=url_overrides)
+        for name, current, latest, status in sorted(results):
+            print "    %-26s %-24s %-24s %s" % \
+                (name, current or '-', latest or '-', status)
+        print "HTTP requests:  %(fetched)d fetched, %(not_modified)d " \
+            "not modified" % http_cache.stats
+        errors = [r for r in results if r[3].startswith('error')]
+        sys.exit(1 if errors else 0)
+
+    if args.prefetch:
+        items = {}
+        for pkg in OBSBuild.registered_packages(args.packages_dir, args=args):
+            for url, path in pkg.prefetch_items():
+                items[os.path.abspath(path)] = url
+        prefetcher = Prefetcher(
+            per_host = args.per_host,
+            bandwidth = args.bandwidth and parse_size(args.bandwidth))
+        print "Prefetching %d source files" % len(items)
+        ok = prefetcher.fetch_all(
+            [(url, path) for path, url in sorted(items.items())],
+            jobs=args.jobs)
+        sys.exit(0 if ok else 1)
+
     ob = OBSBuild.package_inst(args=args)
 
-    if ob.args.unpack:
-        print "Unpacking Debianized source tree"
-        ob.debian_package_source_tree()
-    elif ob.args.build:
-        print "Building package from Debianized source tree"
-        ob.debian_package_dpkg_source()
-        if not ob.args.nocleanup:
-            ob.remove_tmp_dir()
-    else:
-        print "Building source package"
-        ob.debian_package_source_build()
+    try:
+        if ob.args.unpack:
+            print "Unpacking Debianized source tree"
+            ob.debian_package_source_tree()
+        elif ob.args.build:
+            print "Building package from Debianized source tree"
+            ob.debian_package_dpkg_source()
+            if not ob.args.nocleanup:
+                ob.remove_tmp_dir()
+        else:
+            print "Building source package"
+            ob.debian_package_source_build()
+    finally:
+        if args.metrics_dir is not None:
+            OBSBuild.runner.write_metrics(args.metrics_dir, ob.name)